@@ -1,15 +1,12 @@
-import time
-import requests
-import pandas as pd
+import csv
 import logging
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from keboola.component.base import ComponentBase
 from keboola.component.exceptions import UserException
-import queue
-import gc
+from collections import deque
 import aiohttp
 import asyncio
-from keboola.component import CommonInterface
+import orjson
 
 
 # Configuration variables
@@ -18,10 +15,54 @@ KEY_START_DATE = 'start_date'
 KEY_END_DATE = 'end_date'
 KEY_TRANSACTIONAL = 'transactional'
 KEY_MARKETING = 'marketing'
+KEY_INCREMENTAL = 'incremental'
 
 BREVO_TRANSACTIONAL_ENDPOINT = "https://api.brevo.com/v3/smtp/blockedContacts"
 BREVO_MARKETING_ENDPOINT = "https://api.brevo.com/v3/contacts"
 
+TRANSACTIONAL_COLUMNS = ['email', 'reason_message', 'reason_code', 'blockedAt', 'senderEmail']
+MARKETING_COLUMNS = ['id', 'email', 'emailBlacklisted', 'smsBlacklisted', 'createdAt', 'modifiedAt']
+
+# Brevo throttles per account, more concurrent requests than this only queue up on their side
+MAX_WORKERS = 16
+PROGRESS_LOG_INTERVAL = 100
+
+MAX_BACKOFF_SECONDS = 60
+
+
+def split_date_range(start_date, end_date, parts):
+    """Split the inclusive date range into at most `parts` consecutive, non-overlapping day windows."""
+    days = (end_date - start_date).days + 1
+    window_days = -(-days // parts)
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + timedelta(days=window_days - 1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+    return windows
+
+
+def get_retry_delay(headers, default):
+    """Seconds to wait before retrying, as requested by the Retry-After or Brevo's rate limit reset header."""
+    for header in ('Retry-After', 'x-sib-ratelimit-reset'):
+        try:
+            return min(max(float(headers[header]), 0), MAX_BACKOFF_SECONDS)
+        except (KeyError, ValueError):
+            continue
+    return default
+
+
+def is_retryable(status):
+    """Throttled (429) and server error (5xx) responses are retried, other error statuses fail right away."""
+    return status == 429 or status >= 500
+
+
+def describe_error(error):
+    """Error type and message for logs, leaving out the request headers (with the api-key) that aiohttp reprs include."""
+    return f"{type(error).__name__}: {error}"
+
+
 # Set the data directory for local testing
 # if not os.path.exists('/data/'):
 #    os.environ['KBC_DATADIR'] = './data'
@@ -31,155 +72,310 @@ class Component(ComponentBase):
     def __init__(self):
         super().__init__()
         self.setup_logging()
-        self.ci = CommonInterface()
 
     def setup_logging(self):
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
     def run(self):
         logging.info("Starting the component run process")
+        # Taken before fetching, so records changed during the run are not skipped next time
+        run_started_at = datetime.utcnow().isoformat()
         params = self.configuration.parameters
         self.api_token = params.get(KEY_API_TOKEN)
         self.start_date = params.get(KEY_START_DATE)
         self.end_date = params.get(KEY_END_DATE)
         self.transactional = params.get(KEY_TRANSACTIONAL)
         self.marketing = params.get(KEY_MARKETING)
+        self.incremental = params.get(KEY_INCREMENTAL, False)
 
         if not self.api_token:
             raise UserException("API token is missing in the configuration.")
 
-        if self.transactional:
-            logging.info("Starting to fetch transactional contacts")
-            self.get_blocked_contacts()
-            self.write_state_file({"last_run": datetime.utcnow().isoformat()})
-            logging.info("Completed fetching transactional contacts")
-        else:
-            logging.info("Transactional parameter is not set to true. Skipping the data fetch process for transactional contacts.")
-        if self.marketing:
-            logging.info("Starting to fetch marketing contacts")
-            self.get_marketing_contacts()
-            self.write_state_file({"last_run": datetime.utcnow().isoformat()})
-            logging.info("Completed fetching marketing contacts")
-        else:
-            logging.info("Marketing parameter is not set to true. Skipping the data fetch process for marketing contacts.")
+        self.last_run = self.get_state_file().get('last_run') if self.incremental else None
+        if self.last_run:
+            logging.info(f"Incremental run, fetching only contacts changed since {self.last_run}")
+
+        asyncio.run(self.fetch_all_contacts())
 
+        self.write_state_file({"last_run": run_started_at})
         logging.info("Completed the component run process")
 
-    def get_total_records(self, headers, endpoint, segment_id=None):
+    async def get_json(self, session, endpoint, params, max_attempts):
+        """GET the endpoint and decode its JSON body, retrying throttled and transient failures.
+
+        On 429 and 5xx responses waits as long as Brevo asks via Retry-After / x-sib-ratelimit-reset,
+        otherwise backs off exponentially. Raises the last error once all attempts are used, and a
+        UserException right away for any other 4xx response.
+        """
+        for attempt in range(1, max_attempts + 1):
+            delay = min(2 ** (attempt - 1), MAX_BACKOFF_SECONDS)
+            try:
+                async with session.get(endpoint, params=params) as response:
+                    if response.status == 401:
+                        raise UserException("Brevo rejected the API token, please check the configuration.")
+                    if 400 <= response.status < 500 and not is_retryable(response.status):
+                        # A rejected request fails the same way on every retry and every other batch
+                        raise UserException(f"Brevo rejected the request to {endpoint} with params {params}, "
+                                            f"status {response.status}: {await response.text()}")
+                    if not is_retryable(response.status) or attempt == max_attempts:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+                    delay = get_retry_delay(response.headers, delay)
+                    logging.warning(f"{endpoint} returned {response.status}, retrying in {delay}s (Attempt {attempt}/{max_attempts})")
+            except aiohttp.ClientResponseError:
+                # Retryable status, but the retries are used up
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+                logging.error(f"Error fetching {endpoint} on attempt {attempt}/{max_attempts}: {describe_error(e)}")
+                if attempt == max_attempts:
+                    raise
+            # Sleep only after the response is released, so its connection serves other requests meanwhile
+            await asyncio.sleep(delay)
+
+    async def get_total_records(self, session, endpoint, segment_id=None):
         params = {"limit": 1, "offset": 0}
         if segment_id:
             params['segmentId'] = segment_id
 
-        attempts = 3
-        while attempts > 0:
+        logging.info(f"Fetching total number of records from {endpoint} with params {params}")
+        try:
+            data = await self.get_json(session, endpoint, params, max_attempts=3)
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            raise UserException(f"Error fetching total records after multiple attempts: {describe_error(e)}")
+        total_records = data.get('count', 0)
+        logging.info(f"Total records to fetch: {total_records}")
+        return total_records
+
+    async def fetch_contacts_batch(self, session, endpoint, params):
+        offset = params['offset']
+        max_attempts = 10  # Increased number of attempts
+        # Lazy %-style arguments, so the per-batch debug messages cost nothing unless debug logging is on
+        logging.debug("Fetching contacts from %s with params %s", endpoint, params)
+        try:
+            data = await self.get_json(session, endpoint, params, max_attempts)
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            logging.warning(f"Failed to fetch contacts at offset {offset} after {max_attempts} attempts: {describe_error(e)}")
+            return None
+        logging.debug("Fetched %s contacts at offset %s", len(data.get('contacts', [])), offset)
+        return data
+
+    async def fetch_all_contacts(self):
+        headers = {"api-key": self.api_token, "accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+        # One session for both endpoints, so their workers share the connection pool and DNS cache
+        connector = aiohttp.TCPConnector(limit=MAX_WORKERS, limit_per_host=MAX_WORKERS, ttl_dns_cache=300, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=30)
+        # Smaller per-response read buffer than aiohttp's 256 KiB default, bodies are read whole for orjson anyway
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers, read_bufsize=2 ** 16) as session:
+            fetches = []
+            if self.transactional:
+                fetches.append(self.get_blocked_contacts(session))
+            else:
+                logging.info("Transactional parameter is not set to true. Skipping the data fetch process for transactional contacts.")
+            if self.marketing:
+                fetches.append(self.get_marketing_contacts(session))
+            else:
+                logging.info("Marketing parameter is not set to true. Skipping the data fetch process for marketing contacts.")
+            tasks = [asyncio.create_task(fetch) for fetch in fetches]
             try:
-                logging.info(f"Fetching total number of records from {endpoint} with params {params}")
-                response = requests.get(endpoint, headers=headers, params=params)
-                response.raise_for_status()
-                data = response.json()
-                total_records = data.get('count', 0)
-                logging.info(f"Total records to fetch: {total_records}")
-                return total_records
-            except requests.RequestException as e:
-                logging.error(f"Error fetching total records: {e}")
-                attempts -= 1
-                if attempts > 0:
-                    time.sleep(2 ** (3 - attempts))  # Exponential backoff
-                else:
-                    raise UserException(f"Error fetching total records after multiple attempts: {e}")
+                await asyncio.gather(*tasks)
+            finally:
+                # A fatal error on one endpoint stops the other one before the session closes
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def process_batches(self, session, endpoint, batch_size, total_records, output_file_path, columns, segment_id=None, filters=None, windows=None):
+        # Plain deque, the workers share one event loop and never touch it concurrently
+        offsets = deque()
+        if windows:
+            # Each date window is walked page by page until it returns a short page
+            for window in windows:
+                offsets.append((0, window))
+        elif total_records is not None:
+            for offset in range(0, total_records, batch_size):
+                offsets.append((offset, None))
+
+        # Offsets of batches that could not be fetched, their contacts are missing from the output
+        failed_offsets = []
 
-        return 0
+        # Workers hand fetched batches to a single writer, the bounded queue holds them back when writing lags
+        batches = asyncio.Queue(maxsize=64)
 
-    async def fetch_contacts_batch(self, session, offset, batch_size, headers, endpoint, segment_id=None):
-        params = {"limit": batch_size, "offset": offset, "sort": "desc"}
+        transactional = endpoint == BREVO_TRANSACTIONAL_ENDPOINT
+        # Built once, each request only adds its offset (and window) on top
+        base_params = {"limit": batch_size, "sort": "desc"}
         if segment_id:
-            params['segmentId'] = segment_id
+            base_params['segmentId'] = segment_id
+        if filters:
+            base_params.update(filters)
 
-        max_attempts = 10  # Increased number of attempts
-        for attempt in range(max_attempts):
-            try:
-                logging.info(f"Fetching contacts from {endpoint} with params {params} (Attempt {attempt + 1}/{max_attempts})")
-                async with session.get(endpoint, headers=headers, params=params) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-                    contacts = data.get('contacts', [])
-                    valid_contacts = [contact for contact in contacts if contact.get('email') is not None]
-                    logging.info(f"Fetched {len(valid_contacts)} valid contacts at offset {offset}")
-                    return valid_contacts
-            except Exception as e:
-                logging.error(f"Error fetching data on attempt {attempt + 1}: {e}")
-                if attempt < max_attempts - 1:
-                    await asyncio.sleep(2 ** attempt)  # Exponential backoff
+        async def write_batches():
+            seen_emails = set()
+            # A 1 MiB buffer turns the many small batch writes into few large write syscalls
+            with open(output_file_path, 'w', newline='', buffering=1 << 20) as output_file:
+                if transactional:
+                    # Rows are projected to tuples below, in TRANSACTIONAL_COLUMNS order
+                    writer = csv.writer(output_file)
+                    writer.writerow(columns)
                 else:
-                    logging.warning(f"Failed to fetch contacts at offset {offset} after {max_attempts} attempts")
-                    return []
-
-    async def process_batches(self, headers, endpoint, batch_size, total_records, output_file_path, segment_id=None, columns=None):
-        offsets = queue.Queue()
-        for offset in range(0, total_records, batch_size):
-            offsets.put(offset)
+                    # Contacts carry more attributes than the output columns, the extra keys are skipped
+                    writer = csv.DictWriter(output_file, fieldnames=columns, extrasaction='ignore')
+                    writer.writeheader()
+                finished = False
+                while not finished:
+                    pending = [await batches.get()]
+                    # Take every batch that completed meanwhile, so a burst is written with a single call
+                    while not batches.empty():
+                        pending.append(batches.get_nowait())
+                    rows = []
+                    for batch in pending:
+                        if batch is None:
+                            finished = True
+                            continue
+                        offset, contacts = batch
+                        logging.debug("Processing %s fetched contacts at offset %s", len(contacts), offset)
+                        # Single pass that drops contacts without an email and builds the CSV rows
+                        for contact in contacts:
+                            email = contact.get('email')
+                            if not email:
+                                continue
+                            if transactional:
+                                # Offset pages can overlap when contacts get blocked mid-run, keep the first row per email
+                                if email in seen_emails:
+                                    continue
+                                seen_emails.add(email)
+                                # Read the nested 'reason' straight into its columns instead of reshaping the dict
+                                reason = contact.get('reason') or {}
+                                rows.append((email, reason.get('message'), reason.get('code'), contact.get('blockedAt'), contact.get('senderEmail')))
+                            else:
+                                rows.append(contact)
+                    if rows:
+                        logging.debug("Writing %s valid contacts from %s batches to CSV", len(rows), len(pending))
+                        writer.writerows(rows)
 
         async def worker():
-            async with aiohttp.ClientSession() as session:
-                while not offsets.empty():
-                    offset = offsets.get()
-                    logging.info(f"Processing batch at offset {offset}")
-                    contacts = await self.fetch_contacts_batch(session, offset, batch_size, headers, endpoint, segment_id)
-                    if contacts:
-                        logging.info(f"Fetched {len(contacts)} contacts at offset {offset}")
-                        if endpoint == BREVO_TRANSACTIONAL_ENDPOINT:
-                            # Flatten 'reason' dictionary into separate columns
-                            for contact in contacts:
-                                if 'reason' in contact:
-                                    contact['reason_message'] = contact['reason'].get('message')
-                                    contact['reason_code'] = contact['reason'].get('code')
-                                    del contact['reason']
-                            df = pd.DataFrame(contacts, columns=['email', 'reason_message', 'reason_code', 'blockedAt', 'senderEmail'])
-                        else:
-                            df = pd.DataFrame(contacts)
-                            if columns:
-                                df = df[columns]
-
-                        logging.info(f"Writing batch to CSV at offset {offset}")
-                        df.to_csv(output_file_path, mode='a', header=False, index=False)
-                        del df
-                        del contacts
-                        gc.collect()
-                        logging.info(f"Completed processing batch at offset {offset}")
-                    else:
-                        logging.info(f"No contacts fetched at offset {offset}")
-                    offsets.task_done()
-
-        logging.info("Starting threads for batch processing")
-        tasks = [worker() for _ in range(30)]
-        await asyncio.gather(*tasks)
+            while offsets:
+                offset, window = offsets.popleft()
+                # Per-batch logging stays at debug level, progress is reported every PROGRESS_LOG_INTERVAL batches
+                log = logging.info if offset % (batch_size * PROGRESS_LOG_INTERVAL) == 0 else logging.debug
+                if window:
+                    log("Processing batch at offset %s in window %s", offset, window)
+                else:
+                    log("Processing batch at offset %s", offset)
+                params = {**base_params, **window, "offset": offset} if window else {**base_params, "offset": offset}
+                page = await self.fetch_contacts_batch(session, endpoint, params)
+                if page is None:
+                    failed_offsets.append(offset)
+                    if window:
+                        # Without a count there is nothing else to tell the rest of the window is missing
+                        logging.error(f"Window {window} truncated, its contacts from offset {offset} on were not fetched")
+                    continue
+                contacts = page.get('contacts', [])
+                if window and len(contacts) == batch_size:
+                    offsets.append((offset + batch_size, window))
+                await batches.put((offset, contacts))
+
+        writer_task = asyncio.create_task(write_batches())
+        tasks = [writer_task]
+        try:
+            if not offsets and total_records is None:
+                # Every page carries the total count, so the first one replaces a separate count request
+                page = await self.fetch_contacts_batch(session, endpoint, {**base_params, "offset": 0})
+                if not page or 'count' not in page:
+                    raise UserException(f"Error fetching the first page of contacts from {endpoint}")
+                await batches.put((0, page.get('contacts', [])))
+                logging.info(f"Total records to fetch: {page['count']}")
+                for offset in range(batch_size, page['count'], batch_size):
+                    offsets.append((offset, None))
+
+            # Never start more workers than there are batches to fetch
+            worker_count = min(MAX_WORKERS, len(offsets))
+            logging.info(f"Starting {worker_count} workers for batch processing")
+            workers = [asyncio.create_task(worker()) for _ in range(worker_count)]
+            fetching = asyncio.gather(*workers)
+            tasks += [*workers, fetching]
+            await asyncio.wait([fetching, writer_task], return_when=asyncio.FIRST_COMPLETED)
+            if writer_task.done():
+                # The writer only stops before the sentinel when writing failed
+                writer_task.result()
+            await fetching
+            await batches.put(None)
+            await writer_task
+        finally:
+            # After a failed worker or writer, or a failure on the other endpoint, don't leave tasks running
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if failed_offsets:
+            message = f"{len(failed_offsets)} batches from {endpoint} could not be fetched"
+            if self.incremental:
+                # The state moves past these contacts, an incremental load would never fetch them again
+                raise UserException(f"{message}. Failing the run so the next incremental run fetches them again.")
+            logging.warning(f"{message}, their contacts are missing from the output")
         logging.info("All batches processed")
 
-    def get_blocked_contacts(self):
+    async def get_blocked_contacts(self, session):
         logging.info("Fetching transactional contacts - Initializing")
-        headers = {"api-key": self.api_token, "accept": "application/json"}
-        total_records = self.get_total_records(headers, BREVO_TRANSACTIONAL_ENDPOINT)
         batch_size = 100  # Adjust batch size as needed
+        date_range = self.get_transactional_date_range()
+        if date_range and date_range[0] > date_range[1]:
+            logging.info(f"The last run already covered the range up to {date_range[1]}, no transactional contacts to fetch")
+            # No offsets to walk, only the header gets written
+            windows = None
+            total_records = 0
+        elif date_range:
+            # Scan the range in parallel day windows, so no request has to skip a deep offset
+            windows = [{"startDate": start.isoformat(), "endDate": end.isoformat()}
+                       for start, end in split_date_range(*date_range, MAX_WORKERS)]
+            total_records = None
+        else:
+            windows = None
+            total_records = await self.get_total_records(session, BREVO_TRANSACTIONAL_ENDPOINT)
 
-        transactional_file_path = self.create_out_table_definition('transactional_contacts.csv', incremental=True).full_path
-        with open(transactional_file_path, 'w') as f:
-            f.write(','.join(['email', 'reason_message', 'reason_code', 'blockedAt', 'senderEmail']) + '\n')
-
-        asyncio.run(self.process_batches(headers, BREVO_TRANSACTIONAL_ENDPOINT, batch_size, total_records, transactional_file_path))
+        table_def = self.create_out_table_definition('transactional_contacts.csv', incremental=self.incremental, primary_key=['email'])
+        transactional_file_path = table_def.full_path
+        await self.process_batches(session, BREVO_TRANSACTIONAL_ENDPOINT, batch_size, total_records, transactional_file_path, TRANSACTIONAL_COLUMNS, windows=windows)
+        self.write_manifest(table_def)
         logging.info("Fetching transactional contacts - Completed")
 
-    def get_marketing_contacts(self):
+    def get_transactional_date_range(self):
+        """Resolve the blockedAt day range from the configured dates and the last incremental run.
+
+        Returns None when no range is configured, and a range with start after end when nothing is left to fetch.
+        """
+        try:
+            start_date = date.fromisoformat(self.start_date) if self.start_date else None
+            end_date = date.fromisoformat(self.end_date) if self.end_date else datetime.utcnow().date()
+        except ValueError as e:
+            raise UserException(f"Invalid start_date or end_date, expected YYYY-MM-DD: {e}")
+        if start_date and start_date > end_date:
+            raise UserException(f"start_date {start_date} is after end_date {end_date}.")
+        if self.last_run:
+            # May move start_date past end_date, once the last run already covered the whole range
+            last_run_date = datetime.fromisoformat(self.last_run).date()
+            start_date = max(start_date, last_run_date) if start_date else last_run_date
+        if not start_date:
+            if self.end_date:
+                raise UserException("start_date is required when end_date is set.")
+            return None
+        return start_date, end_date
+
+    async def get_marketing_contacts(self, session):
         logging.info("Fetching marketing contacts - Initializing")
-        headers = {"api-key": self.api_token, "accept": "application/json"}
         segment_id = 8
-        total_records = self.get_total_records(headers, BREVO_MARKETING_ENDPOINT, segment_id)
+        if self.last_run:
+            # The delta is usually small, its size is read from the first page instead of a count request
+            filters = {"modifiedSince": datetime.fromisoformat(self.last_run).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'}
+            total_records = None
+        else:
+            filters = None
+            total_records = await self.get_total_records(session, BREVO_MARKETING_ENDPOINT, segment_id)
         batch_size = 1000  # Adjust batch size as needed
 
-        marketing_file_path = self.create_out_table_definition('marketing_contacts.csv', incremental=True).full_path
-        with open(marketing_file_path, 'w') as f:
-            f.write(','.join(['id', 'email', 'emailBlacklisted', 'smsBlacklisted', 'createdAt', 'modifiedAt']) + '\n')
-
-        asyncio.run(self.process_batches(headers, BREVO_MARKETING_ENDPOINT, batch_size, total_records, marketing_file_path, segment_id, columns=['id', 'email', 'emailBlacklisted', 'smsBlacklisted', 'createdAt', 'modifiedAt']))
+        table_def = self.create_out_table_definition('marketing_contacts.csv', incremental=self.incremental, primary_key=['id'])
+        marketing_file_path = table_def.full_path
+        await self.process_batches(session, BREVO_MARKETING_ENDPOINT, batch_size, total_records, marketing_file_path, MARKETING_COLUMNS, segment_id, filters)
+        self.write_manifest(table_def)
         logging.info("Fetching marketing contacts - Completed")
 
 
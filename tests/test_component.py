@@ -6,9 +6,15 @@ Created on 12. 11. 2018
 import unittest
 import mock
 import os
+from datetime import date
+from aiohttp import ClientResponseError, ClientSession, web
+from aiohttp.test_utils import TestServer
 from freezegun import freeze_time
+from keboola.component.exceptions import UserException
 
-from component import Component
+from component import Component, get_retry_delay, is_retryable, split_date_range
+
+API_TOKEN = 'secret-api-token'
 
 
 class TestComponent(unittest.TestCase):
@@ -22,6 +28,135 @@ class TestComponent(unittest.TestCase):
             comp = Component()
             comp.run()
 
+    def test_split_date_range_covers_range_without_overlap(self):
+        windows = split_date_range(date(2024, 1, 1), date(2024, 1, 10), 4)
+        self.assertEqual(windows, [(date(2024, 1, 1), date(2024, 1, 3)),
+                                   (date(2024, 1, 4), date(2024, 1, 6)),
+                                   (date(2024, 1, 7), date(2024, 1, 9)),
+                                   (date(2024, 1, 10), date(2024, 1, 10))])
+
+    def test_split_date_range_shorter_than_parts(self):
+        windows = split_date_range(date(2024, 1, 1), date(2024, 1, 2), 30)
+        self.assertEqual(windows, [(date(2024, 1, 1), date(2024, 1, 1)),
+                                   (date(2024, 1, 2), date(2024, 1, 2))])
+
+    def test_get_retry_delay_prefers_server_hint(self):
+        self.assertEqual(get_retry_delay({'Retry-After': '3'}, 1), 3)
+        self.assertEqual(get_retry_delay({'x-sib-ratelimit-reset': '5'}, 1), 5)
+        self.assertEqual(get_retry_delay({'Retry-After': '3600'}, 1), 60)
+        self.assertEqual(get_retry_delay({'Retry-After': 'soon'}, 2), 2)
+        self.assertEqual(get_retry_delay({}, 2), 2)
+
+    def test_is_retryable_throttled_and_server_errors(self):
+        for status in (429, 500, 501, 503, 520, 524):
+            self.assertTrue(is_retryable(status), status)
+        for status in (200, 400, 401, 404, 422):
+            self.assertFalse(is_retryable(status), status)
+
+    def make_component(self, start_date=None, end_date=None, last_run=None):
+        comp = Component.__new__(Component)
+        comp.start_date = start_date
+        comp.end_date = end_date
+        comp.last_run = last_run
+        return comp
+
+    def test_transactional_date_range_without_dates(self):
+        self.assertIsNone(self.make_component().get_transactional_date_range())
+
+    @freeze_time("2024-03-15")
+    def test_transactional_date_range_defaults_end_to_today(self):
+        comp = self.make_component(start_date='2024-03-01')
+        self.assertEqual(comp.get_transactional_date_range(), (date(2024, 3, 1), date(2024, 3, 15)))
+
+    def test_transactional_date_range_only_end_date_fails(self):
+        with self.assertRaises(UserException):
+            self.make_component(end_date='2024-06-30').get_transactional_date_range()
+
+    def test_transactional_date_range_invalid_format_fails(self):
+        with self.assertRaises(UserException):
+            self.make_component(start_date='01.01.2024').get_transactional_date_range()
+
+    def test_transactional_date_range_start_after_end_fails(self):
+        with self.assertRaises(UserException):
+            self.make_component(start_date='2024-07-01', end_date='2024-06-30').get_transactional_date_range()
+
+    def test_transactional_date_range_later_of_start_and_last_run(self):
+        comp = self.make_component(start_date='2024-01-01', end_date='2024-06-30', last_run='2024-03-10T08:00:00')
+        self.assertEqual(comp.get_transactional_date_range(), (date(2024, 3, 10), date(2024, 6, 30)))
+        comp = self.make_component(start_date='2024-04-01', end_date='2024-06-30', last_run='2024-03-10T08:00:00')
+        self.assertEqual(comp.get_transactional_date_range(), (date(2024, 4, 1), date(2024, 6, 30)))
+
+    def test_transactional_date_range_last_run_only(self):
+        comp = self.make_component(end_date='2024-06-30', last_run='2024-03-10T08:00:00')
+        self.assertEqual(comp.get_transactional_date_range(), (date(2024, 3, 10), date(2024, 6, 30)))
+
+    def test_transactional_date_range_last_run_after_end_is_empty(self):
+        comp = self.make_component(start_date='2024-01-01', end_date='2024-06-30', last_run='2026-10-10T08:00:00')
+        start_date, end_date = comp.get_transactional_date_range()
+        self.assertGreater(start_date, end_date)
+
+
+class TestBrevoRequests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        # Each request is answered with the next (status, headers) pair, the last one repeats
+        self.responses = [(200, {})]
+        self.requests = 0
+        app = web.Application()
+        app.router.add_get('/contacts', self.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.session = ClientSession(headers={"api-key": API_TOKEN})
+        self.url = str(self.server.make_url('/contacts'))
+        self.comp = Component.__new__(Component)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.close()
+
+    async def handle(self, request):
+        status, headers = self.responses[min(self.requests, len(self.responses) - 1)]
+        self.requests += 1
+        return web.json_response({"count": 1, "contacts": []}, status=status, headers=headers)
+
+    async def test_get_json_rejected_token_fails(self):
+        self.responses = [(401, {})]
+        with self.assertRaises(UserException):
+            await self.comp.get_json(self.session, self.url, {}, max_attempts=3)
+        self.assertEqual(self.requests, 1)
+
+    async def test_get_json_rejected_request_fails_with_status(self):
+        self.responses = [(400, {})]
+        with self.assertRaises(UserException) as error:
+            await self.comp.get_json(self.session, self.url, {}, max_attempts=3)
+        self.assertIn('status 400', str(error.exception))
+        self.assertEqual(self.requests, 1)
+
+    @mock.patch('component.asyncio.sleep', new_callable=mock.AsyncMock)
+    async def test_get_json_retries_with_header_delay(self, sleep):
+        self.responses = [(429, {'Retry-After': '7'}), (520, {}), (200, {})]
+        self.assertEqual(await self.comp.get_json(self.session, self.url, {}, max_attempts=3), {"count": 1, "contacts": []})
+        self.assertEqual(self.requests, 3)
+        # The second retry has no header hint and falls back to the exponential backoff
+        self.assertEqual([call.args[0] for call in sleep.await_args_list], [7, 2])
+
+    @mock.patch('component.asyncio.sleep', new_callable=mock.AsyncMock)
+    async def test_get_json_raises_once_retries_are_used_up(self, sleep):
+        self.responses = [(503, {})]
+        with self.assertRaises(ClientResponseError):
+            await self.comp.get_json(self.session, self.url, {}, max_attempts=3)
+        self.assertEqual(self.requests, 3)
+
+    @mock.patch('component.MAX_BACKOFF_SECONDS', 0)
+    async def test_failed_requests_do_not_expose_api_token(self):
+        self.responses = [(503, {})]
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertIsNone(await self.comp.fetch_contacts_batch(self.session, self.url, {"offset": 0}))
+        self.assertNotIn(API_TOKEN, '\n'.join(logs.output))
+        with self.assertRaises(UserException) as error:
+            await self.comp.get_total_records(self.session, self.url)
+        self.assertNotIn(API_TOKEN, str(error.exception))
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']